@@ -1,21 +1,87 @@
 import os
 import docx
 import torch
-from transformers import AutoModelForTokenClassification, AutoTokenizer
+import numpy as np
+from transformers import AutoConfig, AutoModelForTokenClassification, AutoTokenizer
 import re
 from datetime import datetime
 import sqlite3
+import queue
+import threading
+import glob
+import shutil
+import tempfile
+import multiprocessing
+import atexit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
 import secrets
-import string
+import random
 from typing import List, Tuple
 import uuid
 from dataclasses import dataclass
+from contextlib import contextmanager
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
 
 INPUT_FOLDER = "input_docs"
 OUTPUT_FOLDER = "output_docs"
 MODEL_PATH = "models/court_ner_model"
-DATABASE_FILE = "anonymization_mapping.db"
+ONNX_MODEL_PATH = "models/court_ner_model_onnx"
+ONNX_MODEL_FILE = "model_quantized.onnx"
+DATABASE_FILE = os.environ.get("ANONYMIZATION_DB", "anonymization_mapping.db")
+MEMORY_DATABASE_URI = "file:anonymization_mapping?mode=memory&cache=shared"
+NLP_BATCH_SIZE = 32
+NLP_LENGTH_BUCKETS = [8, 16, 32, 64, 128, 256, 512]
+DB_WRITER_BATCH_SIZE = 256
+
+PATTERNS = {
+    'PER': [
+        r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2}\b',
+        r'\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ]\.\s*[А-ЯЁ]\.\b'
+    ],
+    'ADDR': [
+        r'г\.\s*[А-ЯЁ][а-яё-]+,\s*(?:ул\.|просп\.|пер\.|б-р)\s*[А-ЯЁ][а-яё-]+,\s*д\.\s*\d+(?:\s*кв\.\s*\d+)?',
+        r'\bг\.\s*[А-ЯЁ][а-яё-]+\b'
+    ],
+    'DATE': [
+        r'\b\d{1,2}\.\d{1,2}\.\d{4}\b',
+        r'\b\d{1,2}\s+(?:января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+\d{4}\b'
+    ],
+    'PASS': [
+        r'\b(?:паспорт\s+)?(?:\d{4}\s+)?№?\s*\d{6}\b',
+        r'\bсерия\s*\d{4}\s*№\s*\d{6}\b'
+    ],
+    'INN': [
+        r'\bИНН\s*\d{10}(?:\d{2})?\b',
+        r'\b\d{10}(?:\d{2})?\b'
+    ],
+    'PHONE': [
+        r'\b(?:\+7|8)[\s\-\(]?\d{3}[\s\-\)]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}\b'
+    ],
+    'CASE': [
+        r'\bДело\s*№?\s*[\w\-/]+\b',
+        r'\b№\s*[\w\-/]+\b'
+    ]
+}
+
+PATTERN_RE = re.compile('|'.join(
+    f"(?P<{entity_type}_{i}>{pattern})"
+    for entity_type, regex_list in PATTERNS.items()
+    for i, pattern in enumerate(regex_list)
+), re.IGNORECASE)
+
+NLP_PREFILTER_RE = re.compile(r'\d|[А-ЯЁ][а-яё]+\s+[А-ЯЁ]')
+
+ENC_RE = re.compile(r'\[ENC:([a-f0-9]+)\]', re.IGNORECASE)
 
 @dataclass
 class EntityMapping:
@@ -33,55 +99,63 @@ class DataGenerator:
         self.russian_surnames = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов']
         self.cities = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург']
         self.streets = ['Ленина', 'Советская', 'Мира', 'Центральная']
+        self._rng = random.Random()
 
     def generate_fio(self):
-        gender = secrets.choice(['male', 'female'])
+        gender = self._rng.choice(['male', 'female'])
         if gender == 'male':
-            name = secrets.choice(self.russian_male_names)
-            surname = secrets.choice(self.russian_surnames)
-            patronymic = secrets.choice(self.russian_male_names) + 'ович'
+            name = self._rng.choice(self.russian_male_names)
+            surname = self._rng.choice(self.russian_surnames)
+            patronymic = self._rng.choice(self.russian_male_names) + 'ович'
         else:
-            name = secrets.choice(self.russian_female_names)
-            surname = secrets.choice(self.russian_surnames) + 'а'
-            patronymic = secrets.choice(self.russian_male_names) + 'овна'
+            name = self._rng.choice(self.russian_female_names)
+            surname = self._rng.choice(self.russian_surnames) + 'а'
+            patronymic = self._rng.choice(self.russian_male_names) + 'овна'
         return f"{surname} {name} {patronymic}"
 
     def generate_address(self):
-        city = secrets.choice(self.cities)
-        street = secrets.choice(self.streets)
-        house = secrets.randbelow(200) + 1
-        apartment = secrets.randbelow(300) + 1
+        city = self._rng.choice(self.cities)
+        street = self._rng.choice(self.streets)
+        house = self._rng.randrange(200) + 1
+        apartment = self._rng.randrange(300) + 1
         return f"г. {city}, ул. {street}, д. {house}, кв. {apartment}"
 
+    def _random_digits(self, count):
+        return f"{self._rng.randrange(10 ** count):0{count}d}"
+
     def generate_inn(self):
-        return ''.join(secrets.choice(string.digits) for _ in range(12))
+        return self._random_digits(12)
 
     def generate_passport(self):
-        series = ''.join(secrets.choice(string.digits) for _ in range(4))
-        number = ''.join(secrets.choice(string.digits) for _ in range(6))
-        return f"{series} №{number}"
+        digits = self._random_digits(10)
+        return f"{digits[:4]} №{digits[4:]}"
 
     def generate_phone(self):
-        code = secrets.choice(['495', '499', '812'])
-        part1 = ''.join(secrets.choice(string.digits) for _ in range(3))
-        part2 = ''.join(secrets.choice(string.digits) for _ in range(2))
-        part3 = ''.join(secrets.choice(string.digits) for _ in range(2))
-        return f"+7 ({code}) {part1}-{part2}-{part3}"
+        code = self._rng.choice(['495', '499', '812'])
+        digits = self._random_digits(7)
+        return f"+7 ({code}) {digits[:3]}-{digits[3:5]}-{digits[5:]}"
 
     def generate_date(self):
-        year = secrets.choice(range(1950, 2005))
-        month = secrets.choice(range(1, 13))
-        day = secrets.choice(range(1, 29))
+        year = self._rng.randrange(1950, 2005)
+        month = self._rng.randrange(1, 13)
+        day = self._rng.randrange(1, 29)
         return f"{day:02d}.{month:02d}.{year}"
 
     def generate_case_number(self):
-        return f"2-{secrets.randbelow(10000)}/{secrets.choice(range(2020, 2026))}"
+        return f"2-{self._rng.randrange(10000)}/{self._rng.randrange(2020, 2026)}"
 
 class EncryptionManager:
     def __init__(self):
         self.key_file = "encryption.key"
         self.key = self.load_or_generate_key()
-        self.cipher = Fernet(self.key)
+        gcm_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b"xd-aesgcm-v1"
+        ).derive(base64.urlsafe_b64decode(self.key))
+        self.cipher = AESGCM(gcm_key)
+        self.legacy_cipher = Fernet(self.key)
     
     def load_or_generate_key(self):
         if os.path.exists(self.key_file):
@@ -94,16 +168,64 @@ class EncryptionManager:
             return key
     
     def encrypt(self, data):
-        return self.cipher.encrypt(data.encode()).hex()
+        nonce = secrets.token_bytes(12)
+        return (nonce + self.cipher.encrypt(nonce, data.encode(), None)).hex()
     
     def decrypt(self, encrypted_hex):
-        return self.cipher.decrypt(bytes.fromhex(encrypted_hex)).decode()
+        payload = bytes.fromhex(encrypted_hex)
+        try:
+            return self.cipher.decrypt(payload[:12], payload[12:], None).decode()
+        except InvalidTag:
+            return self.legacy_cipher.decrypt(payload).decode()
 
 class DatabaseManager:
-    def __init__(self, encryption_manager=None):
+    INSERT_QUERIES = {
+        'document': '''
+            INSERT OR REPLACE INTO documents (id, original_file, processed_file, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''',
+        'encrypted': '''
+            INSERT INTO encrypted_data (id, document_id, encrypted_text, entity_type, position_start, position_end)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''',
+        'replacement': '''
+            INSERT INTO replacements (id, document_id, original_text, replacement_text, entity_type, position_start, position_end)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        '''
+    }
+    
+    def __init__(self, encryption_manager=None, db_file=None):
         self.encryption_manager = encryption_manager
-        self.conn = sqlite3.connect(DATABASE_FILE)
+        self.db_file = db_file or DATABASE_FILE
+        self.conn = self._connect()
+        self.conn.execute("PRAGMA journal_mode=WAL")
         self.init_database()
+        
+        self._queue = queue.Queue()
+        self._writer_error = None
+        self._writer = threading.Thread(target=self._db_writer, daemon=True)
+        self._writer.start()
+    
+    def _connect(self):
+        if self.db_file == ":memory:":
+            conn = sqlite3.connect(MEMORY_DATABASE_URI, uri=True, isolation_level=None, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+    
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
     
     def init_database(self):
         cursor = self.conn.cursor()
@@ -145,196 +267,290 @@ class DatabaseManager:
         
         self.conn.commit()
     
-    def save_document(self, doc_id, original_file, processed_file):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO documents (id, original_file, processed_file, timestamp)
-            VALUES (?, ?, ?, ?)
-        ''', (doc_id, original_file, processed_file, datetime.now().isoformat()))
-        self.conn.commit()
+    def document_row(self, doc_id, original_file, processed_file):
+        return (doc_id, original_file, processed_file, datetime.now().isoformat())
     
-    def save_encrypted_mapping(self, entity_id, doc_id, encrypted_text, entity_type, start, end):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO encrypted_data (id, document_id, encrypted_text, entity_type, position_start, position_end)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (entity_id, doc_id, encrypted_text, entity_type, start, end))
-        self.conn.commit()
+    def enqueue(self, kind, row):
+        self._queue.put((kind, row))
     
-    def save_replacement(self, entity_id, doc_id, original, replacement, entity_type, start, end):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO replacements (id, document_id, original_text, replacement_text, entity_type, position_start, position_end)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (entity_id, doc_id, original, replacement, entity_type, start, end))
-        self.conn.commit()
+    def flush(self):
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if not self._writer.is_alive():
+                    raise RuntimeError("Поток записи в базу данных остановлен")
+                self._queue.all_tasks_done.wait(0.1)
+        
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
     
-    def get_entity_by_id(self, entity_id):
+    def _db_writer(self):
+        conn = None
+        running = True
+        
+        try:
+            while running:
+                items = [self._queue.get()]
+                try:
+                    while len(items) < DB_WRITER_BATCH_SIZE:
+                        try:
+                            items.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    
+                    running = None not in items
+                    batches = {}
+                    for item in items:
+                        if item is not None:
+                            kind, row = item
+                            batches.setdefault(kind, []).append(row)
+                    
+                    if batches:
+                        if conn is None:
+                            conn = self._connect()
+                        with self._transaction(conn):
+                            for kind, rows in batches.items():
+                                conn.executemany(self.INSERT_QUERIES[kind], rows)
+                except Exception as e:
+                    self._writer_error = e
+                finally:
+                    for _ in items:
+                        self._queue.task_done()
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def get_entities_by_ids(self, entity_ids, chunk_size=500):
+        entity_ids = list(entity_ids)
+        entities = {}
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM encrypted_data WHERE id = ?', (entity_id,))
-        return cursor.fetchone()
+        for i in range(0, len(entity_ids), chunk_size):
+            chunk = entity_ids[i:i + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(f'SELECT * FROM encrypted_data WHERE id IN ({placeholders})', chunk)
+            for row in cursor.fetchall():
+                entities[row[0]] = row
+        return entities
+    
+    def merge_shard(self, shard_file):
+        self.conn.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+        try:
+            tables = {row[0] for row in self.conn.execute("SELECT name FROM shard.sqlite_master WHERE type = 'table'")}
+            with self._transaction(self.conn):
+                for table, verb in [('documents', 'INSERT OR REPLACE'), ('encrypted_data', 'INSERT'), ('replacements', 'INSERT')]:
+                    if table in tables:
+                        self.conn.execute(f"{verb} INTO main.{table} SELECT * FROM shard.{table}")
+        finally:
+            self.conn.execute("DETACH DATABASE shard")
     
     def close(self):
+        self._queue.put(None)
+        self._writer.join()
         self.conn.close()
 
 class Anonymizer:
-    def __init__(self, mode='replace'):
+    def __init__(self, mode='replace', batch_size=NLP_BATCH_SIZE, db_file=None, compile_model=True):
         self.mode = mode
+        self.batch_size = batch_size
+        
+        onnx_file = os.path.join(ONNX_MODEL_PATH, ONNX_MODEL_FILE)
         
-        if os.path.exists(MODEL_PATH):
-            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+        if onnxruntime is not None and os.path.exists(onnx_file):
+            self.tokenizer = self._load_tokenizer(ONNX_MODEL_PATH)
+            self.session = onnxruntime.InferenceSession(onnx_file, providers=["CPUExecutionProvider"])
+            self.session_inputs = [i.name for i in self.session.get_inputs()]
+            self.id2label = AutoConfig.from_pretrained(ONNX_MODEL_PATH).id2label
+            self.backend = 'onnx'
+            self.use_nlp_model = True
+        elif os.path.exists(MODEL_PATH):
+            self.tokenizer = self._load_tokenizer(MODEL_PATH)
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            if self.device == "cuda":
+                self.dtype = torch.float16
+            elif torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                self.dtype = torch.bfloat16
+            else:
+                self.dtype = torch.float32
             self.model = AutoModelForTokenClassification.from_pretrained(MODEL_PATH)
+            self.model.to(self.device, dtype=self.dtype)
             self.model.eval()
             self.id2label = self.model.config.id2label
+            self.backend = 'torch'
             self.use_nlp_model = True
+            if compile_model:
+                self._optimize_model()
         else:
             print(f"Внимание: Модель не найдена в {MODEL_PATH}. Используется regex-режим.")
             self.use_nlp_model = False
         
         if mode == 'encrypt':
             self.encryption_manager = EncryptionManager()
-            self.db_manager = DatabaseManager(self.encryption_manager)
+            self.db_manager = DatabaseManager(self.encryption_manager, db_file=db_file)
         else:
-            self.db_manager = DatabaseManager()
+            self.db_manager = DatabaseManager(db_file=db_file)
         
         self.data_generator = DataGenerator()
+        self._repl_cache = {}
         self.stats = {'found': 0, 'processed': 0}
     
+    def _optimize_model(self):
+        if tuple(int(part) for part in re.findall(r'\d+', torch.__version__)[:2]) < (2, 1):
+            return
+        
+        try:
+            from optimum.bettertransformer import BetterTransformer
+            self.model = BetterTransformer.transform(self.model)
+        except (ImportError, ValueError, NotImplementedError):
+            pass
+        except Exception as e:
+            print(f"Внимание: BetterTransformer недоступен ({e}). Используется стандартное внимание.")
+        
+        eager_model = self.model
+        
+        try:
+            self.model = torch.compile(eager_model, mode="reduce-overhead", fullgraph=False)
+            for bucket_size in NLP_LENGTH_BUCKETS:
+                for rows in sorted({1, self.batch_size}):
+                    dummy = self.tokenizer(
+                        ["."] * rows,
+                        return_tensors="pt",
+                        padding="max_length",
+                        max_length=bucket_size,
+                        truncation=True
+                    )
+                    self._predict(dummy)
+        except Exception as e:
+            print(f"Внимание: torch.compile недоступен ({e}). Используется обычный режим.")
+            self.model = eager_model
+    
+    def _load_tokenizer(self, path):
+        tokenizer = AutoTokenizer.from_pretrained(path, use_fast=True)
+        if not tokenizer.is_fast:
+            raise ValueError(f"Для модели {path} требуется быстрый токенизатор (tokenizer.json)")
+        tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
+        return tokenizer
+    
     def find_entities_by_patterns(self, text):
         entities = []
         
-        patterns = {
-            'PER': [
-                r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+){1,2}\b',
-                r'\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ]\.\s*[А-ЯЁ]\.\b'
-            ],
-            'ADDR': [
-                r'г\.\s*[А-ЯЁ][а-яё-]+,\s*(?:ул\.|просп\.|пер\.|б-р)\s*[А-ЯЁ][а-яё-]+,\s*д\.\s*\d+(?:\s*кв\.\s*\d+)?',
-                r'\bг\.\s*[А-ЯЁ][а-яё-]+\b'
-            ],
-            'DATE': [
-                r'\b\d{1,2}\.\d{1,2}\.\d{4}\b',
-                r'\b\d{1,2}\s+(?:января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)\s+\d{4}\b'
-            ],
-            'PASS': [
-                r'\b(?:паспорт\s+)?(?:\d{4}\s+)?№?\s*\d{6}\b',
-                r'\bсерия\s*\d{4}\s*№\s*\d{6}\b'
-            ],
-            'INN': [
-                r'\bИНН\s*\d{10}(?:\d{2})?\b',
-                r'\b\d{10}(?:\d{2})?\b'
-            ],
-            'PHONE': [
-                r'\b(?:\+7|8)[\s\-\(]?\d{3}[\s\-\)]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}\b'
-            ],
-            'CASE': [
-                r'\bДело\s*№?\s*[\w\-/]+\b',
-                r'\b№\s*[\w\-/]+\b'
-            ]
-        }
-        
-        for entity_type, regex_list in patterns.items():
-            for pattern in regex_list:
-                for match in re.finditer(pattern, text, re.IGNORECASE):
-                    start, end = match.span()
-                    if start > 0 and text[start-1].isalnum():
-                        continue
-                    if end < len(text) and text[end].isalnum():
-                        continue
-                    
-                    entity_text = match.group()
-                    entities.append({
-                        'text': entity_text,
-                        'type': entity_type,
-                        'start': start,
-                        'end': end
-                    })
+        for match in PATTERN_RE.finditer(text):
+            start, end = match.span()
+            if start > 0 and text[start-1].isalnum():
+                continue
+            if end < len(text) and text[end].isalnum():
+                continue
+            
+            entity_text = match.group()
+            entities.append({
+                'text': entity_text,
+                'type': match.lastgroup.rsplit('_', 1)[0],
+                'start_char': start,
+                'end_char': end
+            })
         
         return entities
     
-    def extract_entities(self, text):
+    def extract_entities_batch(self, texts):
         if self.use_nlp_model:
-            return self._extract_with_nlp(text)
+            return self._extract_with_nlp_batch(texts)
         else:
-            return self.find_entities_by_patterns(text)
+            return [self.find_entities_by_patterns(text) for text in texts]
     
-    def _extract_with_nlp(self, text):
-        inputs = self.tokenizer(text, return_tensors="pt", truncation=True, max_length=512)
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            predictions = torch.argmax(outputs.logits, dim=2)
+    def _extract_with_nlp_batch(self, texts):
+        results = [[] for _ in texts]
+        candidates = [i for i, text in enumerate(texts) if NLP_PREFILTER_RE.search(text)]
+        if not candidates:
+            return results
+        
+        encoded = self.tokenizer(
+            [texts[i] for i in candidates],
+            truncation=True,
+            max_length=512,
+            return_offsets_mapping=True
+        )
+        offsets = encoded.pop('offset_mapping')
+        lengths = np.array([len(ids) for ids in encoded['input_ids']])
+        buckets = np.digitize(lengths, NLP_LENGTH_BUCKETS, right=True)
+        perm = np.argsort(lengths, kind='stable')
+        
+        batches = []
+        for bucket in np.unique(buckets):
+            members = [j for j in perm if buckets[j] == bucket]
+            for batch_start in range(0, len(members), self.batch_size):
+                batches.append((NLP_LENGTH_BUCKETS[bucket], members[batch_start:batch_start + self.batch_size]))
+        
+        for bucket_size, batch_rows in batches:
+            inputs = self.tokenizer.pad(
+                [{key: values[j] for key, values in encoded.items()} for j in batch_rows],
+                padding="max_length",
+                max_length=bucket_size,
+                return_tensors="np" if self.backend == 'onnx' else "pt"
+            )
+            predictions = self._predict(inputs)
+            
+            for row, j in enumerate(batch_rows):
+                text_idx = candidates[j]
+                mask = inputs['attention_mask'][row] == 1
+                tokens = self.tokenizer.convert_ids_to_tokens(inputs['input_ids'][row][mask])
+                labels = [self.id2label[p.item()] for p in predictions[row][mask]]
+                results[text_idx] = self._collect_entities(texts[text_idx], tokens, labels, offsets[j])
+        
+        return results
+    
+    def _predict(self, inputs):
+        if self.backend == 'onnx':
+            logits = self.session.run(None, {name: inputs[name] for name in self.session_inputs})[0]
+            return logits.argmax(axis=2)
         
-        tokens = self.tokenizer.convert_ids_to_tokens(inputs['input_ids'][0])
-        labels = [self.id2label[p.item()] for p in predictions[0]]
+        model_inputs = {k: v.to(self.device, non_blocking=True) for k, v in inputs.items()}
         
+        with torch.inference_mode():
+            outputs = self.model(**model_inputs)
+            return torch.argmax(outputs.logits, dim=2).cpu()
+    
+    def _collect_entities(self, text, tokens, labels, offsets):
         entities = []
-        current_entity = []
         current_type = None
         current_start = 0
+        current_end = 0
+        
+        def flush():
+            start_char = offsets[current_start][0]
+            end_char = offsets[current_end][1]
+            entity_text = text[start_char:end_char]
+            if self._is_valid_entity(entity_text, current_type):
+                entities.append({
+                    'text': entity_text,
+                    'type': current_type,
+                    'start_char': start_char,
+                    'end_char': end_char
+                })
         
         for i, (token, label) in enumerate(zip(tokens, labels)):
             if token in ['[CLS]', '[SEP]', '[PAD]']:
                 continue
             
             if label.startswith('B-'):
-                if current_entity:
-                    entity_text = self._tokens_to_text(current_entity)
-                    if self._is_valid_entity(entity_text, current_type):
-                        entities.append({
-                            'text': entity_text,
-                            'type': current_type,
-                            'start': current_start,
-                            'end': i
-                        })
+                if current_type is not None:
+                    flush()
                 
-                current_entity = [token]
                 current_type = label[2:]
                 current_start = i
+                current_end = i
             
             elif label.startswith('I-') and current_type == label[2:]:
-                current_entity.append(token)
+                current_end = i
             
             elif label == 'O':
-                if current_entity:
-                    entity_text = self._tokens_to_text(current_entity)
-                    if self._is_valid_entity(entity_text, current_type):
-                        entities.append({
-                            'text': entity_text,
-                            'type': current_type,
-                            'start': current_start,
-                            'end': i
-                        })
-                current_entity = []
+                if current_type is not None:
+                    flush()
                 current_type = None
         
-        if current_entity:
-            entity_text = self._tokens_to_text(current_entity)
-            if self._is_valid_entity(entity_text, current_type):
-                entities.append({
-                    'text': entity_text,
-                    'type': current_type,
-                    'start': current_start,
-                    'end': len(tokens)
-                })
-        
-        for entity in entities:
-            entity['start_char'] = min(entity['start'] * 5, len(text))
-            entity['end_char'] = min(entity['end'] * 5, len(text))
+        if current_type is not None:
+            flush()
         
         return entities
     
-    def _tokens_to_text(self, tokens):
-        text = ""
-        for token in tokens:
-            if token.startswith('##'):
-                text += token[2:]
-            else:
-                if text:
-                    text += " "
-                text += token
-        return text.replace('▁', ' ').strip()
-    
     def _is_valid_entity(self, text, entity_type):
         if not text or len(text) < 2:
             return False
@@ -368,73 +584,105 @@ class Anonymizer:
         
         print(f"Обработка документа...")
         
-        for para_idx, para in enumerate(doc.paragraphs):
+        paragraphs = [para for para in doc.paragraphs if para.text.strip()]
+        batch_entities = self.extract_entities_batch([para.text for para in paragraphs])
+        
+        for para, entities in zip(paragraphs, batch_entities):
             text = para.text
-            if not text.strip():
-                continue
-            
-            entities = self.extract_entities(text)
             self.stats['found'] += len(entities)
             
             if not entities:
                 continue
             
-            sorted_entities = sorted(entities, key=lambda x: x.get('start_char', text.find(x['text'])), reverse=True)
+            sorted_entities = sorted(entities, key=lambda x: (x['start_char'], -x['end_char']))
+            spans = []
+            cursor = 0
             
             for entity in sorted_entities:
                 original = entity['text']
                 etype = entity['type']
+                pos = entity['start_char']
+                end_pos = entity['end_char']
                 
-                if 'start_char' in entity:
-                    pos = entity['start_char']
-                    end_pos = entity['end_char']
-                else:
-                    pos = text.find(original)
-                    end_pos = pos + len(original)
-                
-                if pos == -1:
+                if pos < cursor:
                     continue
                 
                 if self.mode == 'replace':
                     replacement = self._generate_replacement(etype, original)
                     
                     entity_id = str(uuid.uuid4())[:8]
-                    self.db_manager.save_replacement(
-                        entity_id, doc_id, original, replacement, etype, pos, end_pos
-                    )
-                    
-                    text = text[:pos] + replacement + text[end_pos:]
-                    self.stats['processed'] += 1
+                    self.db_manager.enqueue('replacement', (entity_id, doc_id, original, replacement, etype, pos, end_pos))
                 
                 elif self.mode == 'encrypt':
                     encrypted = self.encryption_manager.encrypt(original)
                     entity_id = str(uuid.uuid4())[:8]
                     replacement = f"[ENC:{entity_id}]"
                     
-                    self.db_manager.save_encrypted_mapping(
-                        entity_id, doc_id, encrypted, etype, pos, end_pos
-                    )
-                    
-                    text = text[:pos] + replacement + text[end_pos:]
-                    self.stats['processed'] += 1
+                    self.db_manager.enqueue('encrypted', (entity_id, doc_id, encrypted, etype, pos, end_pos))
                 
                 elif self.mode == 'blur':
-                    replacement = '█' * len(original)
-                    text = text[:pos] + replacement + text[end_pos:]
-                    self.stats['processed'] += 1
+                    replacement = '█' * (end_pos - pos)
+                
+                else:
+                    continue
+                
+                spans.append((pos, end_pos, replacement))
+                cursor = end_pos
+                self.stats['processed'] += 1
             
-            if text != para.text:
-                para.clear()
-                para.add_run(text)
+            if spans:
+                self._replace_in_runs(para, spans)
         
-        self.db_manager.save_document(doc_id, os.path.basename(input_path), os.path.basename(output_path))
+        self.db_manager.enqueue('document', self.db_manager.document_row(
+            doc_id, os.path.basename(input_path), os.path.basename(output_path)
+        ))
+        self.db_manager.flush()
         
         doc.save(output_path)
-        self.db_manager.close()
         
         return doc_id
     
+    def shutdown(self):
+        self.db_manager.close()
+    
+    def _apply_replacements(self, text, spans):
+        parts = []
+        cursor = 0
+        for start, end, replacement in spans:
+            parts.append(text[cursor:start])
+            parts.append(replacement)
+            cursor = end
+        parts.append(text[cursor:])
+        return ''.join(parts)
+    
+    def _replace_in_runs(self, para, spans):
+        runs = []
+        offset = 0
+        for run in para.runs:
+            runs.append((offset, offset + len(run.text), run))
+            offset += len(run.text)
+        
+        if ''.join(run.text for _, _, run in runs) != para.text:
+            text = self._apply_replacements(para.text, spans)
+            para.clear()
+            para.add_run(text)
+            return
+        
+        for start, end, replacement in reversed(spans):
+            first = True
+            for run_start, run_end, run in runs:
+                if run_start == run_end or run_end <= start or run_start >= end:
+                    continue
+                local_start = max(start - run_start, 0)
+                local_end = min(end, run_end) - run_start
+                run.text = run.text[:local_start] + (replacement if first else '') + run.text[local_end:]
+                first = False
+    
     def _generate_replacement(self, entity_type, original=""):
+        key = (entity_type, original)
+        if key in self._repl_cache:
+            return self._repl_cache[key]
+        
         generators = {
             'PER': self.data_generator.generate_fio,
             'ADDR': self.data_generator.generate_address,
@@ -447,9 +695,12 @@ class Anonymizer:
         
         generator = generators.get(entity_type)
         if generator:
-            return generator()
+            replacement = generator()
         else:
-            return f"[{entity_type}]"
+            replacement = f"[{entity_type}]"
+        
+        self._repl_cache[key] = replacement
+        return replacement
     
     def decrypt_document(self, encrypted_file_path, output_path):
         if self.mode != 'encrypt' or not hasattr(self, 'encryption_manager'):
@@ -457,30 +708,147 @@ class Anonymizer:
             return False
         
         doc = docx.Document(encrypted_file_path)
-        
-        for para in doc.paragraphs:
-            text = para.text
+        paragraphs = [(para, para.text) for para in doc.paragraphs]
+        
+        entity_ids = {match.group(1) for _, text in paragraphs for match in ENC_RE.finditer(text)}
+        entities = self.db_manager.get_entities_by_ids(entity_ids)
+        
+        def decrypt_match(match):
+            entity_id = match.group(1)
+            entity_data = entities.get(entity_id)
+            if not entity_data:
+                return match.group(0)
+            try:
+                return self.encryption_manager.decrypt(entity_data[2])
+            except Exception:
+                print(f"Ошибка расшифровки для ID: {entity_id}")
+                return match.group(0)
+        
+        for para, text in paragraphs:
+            spans = []
+            for match in ENC_RE.finditer(text):
+                decrypted = decrypt_match(match)
+                if decrypted != match.group(0):
+                    spans.append((match.start(), match.end(), decrypted))
             
-            enc_pattern = r'\[ENC:([a-f0-9]+)\]'
-            for match in re.finditer(enc_pattern, text, re.IGNORECASE):
-                entity_id = match.group(1)
-                
-                entity_data = self.db_manager.get_entity_by_id(entity_id)
-                if entity_data:
-                    encrypted_text = entity_data[2]
-                    try:
-                        decrypted = self.encryption_manager.decrypt(encrypted_text)
-                        text = text.replace(match.group(0), decrypted)
-                    except:
-                        print(f"Ошибка расшифровки для ID: {entity_id}")
-            
-            if text != para.text:
-                para.clear()
-                para.add_run(text)
+            if spans:
+                self._replace_in_runs(para, spans)
         
         doc.save(output_path)
         return True
 
+def export_onnx_model(model_path=MODEL_PATH, save_dir=ONNX_MODEL_PATH):
+    from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    
+    ort_model = ORTModelForTokenClassification.from_pretrained(model_path, export=True)
+    quantizer = ORTQuantizer.from_pretrained(ort_model)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=save_dir, quantization_config=quantization_config)
+    
+    AutoConfig.from_pretrained(model_path).save_pretrained(save_dir)
+    AutoTokenizer.from_pretrained(model_path, use_fast=True).save_pretrained(save_dir)
+    return os.path.join(save_dir, ONNX_MODEL_FILE)
+
+def make_output_name(input_file, timestamp):
+    return f"обработанный_{input_file.replace('.docx', '')}_{timestamp}.docx"
+
+_ANON = None
+
+def _init_worker(mode, shard_dir, num_threads):
+    global _ANON
+    torch.set_num_threads(num_threads)
+    shard_file = os.path.join(shard_dir, f"shard_{os.getpid()}.db")
+    _ANON = Anonymizer(mode=mode, db_file=shard_file)
+    atexit.register(_ANON.shutdown)
+
+def _process_file(input_path, output_path):
+    before = dict(_ANON.stats)
+    doc_id = _ANON.process_document(input_path, output_path)
+    return doc_id, {key: _ANON.stats[key] - before[key] for key in before}
+
+def process_folder(input_dir=INPUT_FOLDER, output_dir=OUTPUT_FOLDER, mode='replace', workers=None):
+    files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith('.docx'))
+    results = {}
+    stats = {'found': 0, 'processed': 0}
+    if not files:
+        return results, stats
+    
+    cpu_count = os.cpu_count() or 1
+    if workers is None:
+        workers = max(1, cpu_count // 2)
+    workers = min(workers, len(files))
+    if torch.cuda.is_available():
+        workers = min(workers, 4)
+        num_threads = 1
+    else:
+        num_threads = max(1, cpu_count // workers)
+    
+    if mode == 'encrypt':
+        EncryptionManager()
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    shard_dir = tempfile.mkdtemp(prefix="anonymization_shards_")
+    
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(mode, shard_dir, num_threads)
+        ) as executor:
+            futures = {}
+            for input_file in files:
+                input_path = os.path.join(input_dir, input_file)
+                output_path = os.path.join(output_dir, make_output_name(input_file, timestamp))
+                futures[executor.submit(_process_file, input_path, output_path)] = (input_file, output_path)
+            
+            for future in as_completed(futures):
+                input_file, output_path = futures[future]
+                try:
+                    doc_id, doc_stats = future.result()
+                except Exception as e:
+                    print(f"✗ Ошибка обработки {input_file}: {e}")
+                    results[input_file] = (None, output_path, e)
+                    continue
+                
+                results[input_file] = (doc_id, output_path, None)
+                for key in stats:
+                    stats[key] += doc_stats[key]
+    finally:
+        _merge_shards(shard_dir, mode)
+    
+    return results, stats
+
+def _merge_shards(shard_dir, mode):
+    failed = []
+    try:
+        db_manager = DatabaseManager(EncryptionManager() if mode == 'encrypt' else None)
+        try:
+            for shard_file in sorted(glob.glob(os.path.join(shard_dir, "shard_*.db"))):
+                try:
+                    db_manager.merge_shard(shard_file)
+                except Exception as e:
+                    print(f"✗ Ошибка объединения {shard_file}: {e}")
+                    failed.append(shard_file)
+                    continue
+                
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(shard_file + suffix):
+                        os.remove(shard_file + suffix)
+        finally:
+            db_manager.close()
+    except Exception:
+        print(f"Внимание: данные сопоставлений сохранены в {shard_dir}")
+        raise
+    
+    if failed:
+        print(f"Внимание: данные сопоставлений сохранены в {shard_dir}")
+    else:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    
+    return failed
+
 def show_files():
     files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith('.docx')]
     
@@ -513,12 +881,15 @@ def main():
     files = show_files()
     
     print("\nДоступные файлы:")
+    print("0. Все файлы (пакетная обработка)")
     for i, f in enumerate(files, 1):
         print(f"{i}. {f}")
     
+    anonymizer = None
+    
     try:
         choice = int(input("\nВыберите файл: ")) - 1
-        if choice < 0 or choice >= len(files):
+        if choice < -1 or choice >= len(files):
             print("Неверный выбор")
             return
         
@@ -542,11 +913,27 @@ def main():
             print("Неверный выбор")
             return
         
+        if choice == -1:
+            print(f"\nРежим: {mode_name}")
+            print("Пакетная обработка...")
+            
+            results, stats = process_folder(INPUT_FOLDER, OUTPUT_FOLDER, mode)
+            
+            print(f"\n✓ Обработка завершена!")
+            failed = [name for name, (_, _, error) in results.items() if error is not None]
+            print(f"  Обработано файлов: {len(results) - len(failed)}")
+            if failed:
+                print(f"  Ошибки в файлах: {', '.join(failed)}")
+            print(f"  Найдено сущностей: {stats['found']}")
+            print(f"  Обработано сущностей: {stats['processed']}")
+            print(f"  Папка результатов: {OUTPUT_FOLDER}")
+            return
+        
         input_file = files[choice]
         input_path = os.path.join(INPUT_FOLDER, input_file)
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_name = f"обработанный_{input_file.replace('.docx', '')}_{timestamp}.docx"
+        output_name = make_output_name(input_file, timestamp)
         output_path = os.path.join(OUTPUT_FOLDER, output_name)
         
         print(f"\nРежим: {mode_name}")
@@ -578,6 +965,10 @@ def main():
         print(f"\n✗ Ошибка: {e}")
         import traceback
         traceback.print_exc()
+    
+    finally:
+        if anonymizer is not None:
+            anonymizer.shutdown()
 
 if __name__ == "__main__":
     main()